@@ -1,148 +1,290 @@
-from typing import Callable, List, Optional, Tuple
+import os
+import sys
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from itertools import repeat
+from math import hypot, inf
+from typing import Dict, List, Sequence, Tuple
 
 #####################################################
 # Authors: Pol Rubio Borrego, Lea Cornelis Martínez #
 # Date: 2024-05-17 #
 #####################################################
 
+Order = Tuple[int, int, Tuple[int, ...], int]
+Menu = Tuple['Ingredient', List['Ingredient'], List['Ingredient'], List['Ingredient'], List['Ingredient']]
+
 class InsufficientStockError(Exception):
     pass
 
-class TreeNode:
-    def __init__(self, name: str, ingredient: Optional['Ingredient'] = None, action: Optional[Callable[[], None]] = None, stock_check: bool = False):
-        self.name: str = name
-        self.ingredient: Optional['Ingredient'] = ingredient
-        self.action: Optional[Callable[[], None]] = action
-        self.stock_check: bool = stock_check
-        self.children: List['TreeNode'] = []
-
-    def add_child(self, child_node: 'TreeNode') -> None:
-        self.children.append(child_node)
-
-
 class Ingredient:
-    def __init__(self, name: str, stock: int, quantity: int, position: Tuple[int, int]):
+    __slots__ = ("name", "total_stock", "stock", "quantity", "px", "py", "trigger", "_ratio_scale")
+
+    def __init__(self, name: str, stock: int, quantity: int, position: Tuple[int, int], threshold_percentage: int = 20):
         self.name: str = name
         self.total_stock: int = stock
         self.stock: int = stock
         self.quantity: int = quantity
-        self.position: Tuple[int, int] = position
-
-    def use(self) -> None:
-        if self.stock >= self.quantity:
-            self.stock -= self.quantity
-            print(f"{self.name} used. Remaining stock: {self.stock} units ({round((self.stock / self.total_stock) * 100, 2)}%)")
-        else:
+        self.px: int = position[0]
+        self.py: int = position[1]
+        # Smallest stock that is not below threshold_percentage of the total
+        self.trigger: int = -(-stock * threshold_percentage // 100)
+        self._ratio_scale: float = 100.0 / stock if stock else 0.0
+
+    @property
+    def position(self) -> Tuple[int, int]:
+        return (self.px, self.py)
+
+    def try_use(self) -> bool:
+        if self.stock < self.quantity:
+            return False
+        self.stock -= self.quantity
+        return True
+
+    def use(self) -> str:
+        if not self.try_use():
             raise InsufficientStockError(f"Insufficient stock for {self.name}")
+        return self.stock_report()
+
+    def stock_report(self) -> str:
+        return f"{self.name} used. Remaining stock: {self.stock} units ({round(self.stock * self._ratio_scale, 2)}%)"
 
     def check_stock(self) -> bool:
         return self.stock >= self.quantity
 
-    def is_below_threshold(self, threshold_percentage: float = 20.0) -> bool:
-        return (self.stock / self.total_stock) * 100 < threshold_percentage
+    def is_below_threshold(self) -> bool:
+        return self.stock < self.trigger
 
 
 class CooLex:
-    def __init__(self, bowls: Ingredient, bases: List[Ingredient], proteins: List[Ingredient], toppings: List[Ingredient], sauces: List[Ingredient]):
+    def __init__(self, bowls: Ingredient, bases: List[Ingredient], proteins: List[Ingredient], toppings: List[Ingredient], sauces: List[Ingredient], verbose: bool = True):
         self.bowls: Ingredient = bowls
         self.bases: List[Ingredient] = bases
         self.proteins: List[Ingredient] = proteins
         self.toppings: List[Ingredient] = toppings
         self.sauces: List[Ingredient] = sauces
-        self.root: TreeNode = self.create_tree()
         self.initial_position: Tuple[int, int] = (310, 310)
-        self.bowl_dispenser_position: Tuple[int, int] = (650, 660)
         self.final_position: Tuple[int, int] = (410, 610)
-        self.current_position: Tuple[int, int] = self.initial_position
-        self.total_distance: float = 0.0
-
-    def create_tree(self) -> TreeNode:
-        root = TreeNode("Start")
-
-        bowl_node = TreeNode("Bowl", ingredient=self.bowls, action=self.bowls.use, stock_check=True)
-        root.add_child(bowl_node)
-
-        base_nodes = [TreeNode(base.name, ingredient=base, action=base.use, stock_check=True) for base in self.bases]
-        bowl_node.children.extend(base_nodes)
-
-        for base_node in base_nodes:
-            protein_nodes = [TreeNode(protein.name, ingredient=protein, action=protein.use, stock_check=True) for protein in self.proteins]
-            base_node.children.extend(protein_nodes)
-
-            for protein_node in protein_nodes:
-                topping_nodes = [TreeNode(topping.name, ingredient=topping, action=topping.use, stock_check=True) for topping in self.toppings]
-                protein_node.children.extend(topping_nodes)
 
-                for topping_node in topping_nodes:
-                    sauce_nodes = [TreeNode(sauce.name, ingredient=sauce, action=sauce.use, stock_check=True) for sauce in self.sauces]
-                    topping_node.children.extend(sauce_nodes)
-
-        return root
-
-    def move_to(self, ingredient: Ingredient) -> None:
-        position = ingredient.position
-        print(f"\nMoving to : {ingredient.name}")
-        distance = self.distance(self.current_position, position)
+        # Ingredients are numbered contiguously by category; the robot's fixed waypoints are appended after them
+        self.ingredients: List[Ingredient] = [bowls, *bases, *proteins, *toppings, *sauces]
+        self.bowl_id: int = 0
+        self.base_offset: int = 1
+        self.protein_offset: int = self.base_offset + len(bases)
+        self.topping_offset: int = self.protein_offset + len(proteins)
+        self.sauce_offset: int = self.topping_offset + len(toppings)
+        self.initial_id: int = len(self.ingredients)
+        self.final_id: int = self.initial_id + 1
+        self.names: List[str] = [ingredient.name for ingredient in self.ingredients] + ["Initial Position", "Final Position"]
+        self.positions: List[Tuple[int, int]] = [(ingredient.px, ingredient.py) for ingredient in self.ingredients] + [self.initial_position, self.final_position]
+        self.distances: List[List[float]] = [[self.distance(p1, p2) for p2 in self.positions] for p1 in self.positions]
+
+        self.current_id: int = self.initial_id
+        self.total_distance: float = 0.0
+        # Topping routes only depend on the protein, the set of toppings and the sauce. The cache pays off
+        # for a long-lived instance such as the interactive loop; simulate_orders builds a new CooLex per order.
+        self.topping_routes: Dict[Tuple[int, Tuple[int, ...], int], Tuple[int, ...]] = {}
+        self.max_topping_routes: int = 4096
+        self.verbose: bool = verbose
+        self.log: List[str] = []
+
+    def category_id(self, offset: int, options: List[Ingredient], index: int) -> int:
+        if not 0 <= index < len(options):
+            raise IndexError(f"Option {index} is out of range for a menu of {len(options)} ingredients")
+        return offset + index
+
+    def move_to(self, target_id: int) -> None:
+        distance = self.distances[self.current_id][target_id]
         self.total_distance += distance
-        print(f"Moving from {self.current_position} to {position} -- Distance: {round(distance, 2)} u.m.")
-        self.current_position = position
+        if self.verbose:
+            self.log.append(f"\nMoving to : {self.names[target_id]}")
+            self.log.append(f"Moving from {self.positions[self.current_id]} to {self.positions[target_id]} -- Distance: {round(distance, 2)} u.m.")
+        self.current_id = target_id
     
     def distance(self, position1: Tuple[int, int], position2: Tuple[int, int]) -> float:
-        return ((position1[0] - position2[0]) ** 2 + (position1[1] - position2[1]) ** 2) ** 0.5
-
-    def traverse_and_prepare(self, next_node: TreeNode) -> None:
-        if next_node.action and next_node.ingredient:
-            ingredient: Ingredient = next_node.ingredient
-            self.move_to(ingredient)
-            next_node.action()
-            if next_node.stock_check and ingredient.is_below_threshold():
-                self.alert_stock(ingredient.name)
-        self.current_node = next_node
+        return hypot(position1[0] - position2[0], position1[1] - position2[1])
+
+    def _run_path(self, path_ids: List[int]) -> None:
+        ingredients = self.ingredients
+        log = self.log
+        verbose = self.verbose
+        for ingredient_id in path_ids:
+            ingredient = ingredients[ingredient_id]
+            self.move_to(ingredient_id)
+            # Stock for the whole order was already checked by short_ingredient
+            ingredient.try_use()
+            if verbose:
+                log.append(ingredient.stock_report())
+
+    def short_ingredient(self, path_ids: List[int]) -> int:
+        ingredients = self.ingredients
+        # Count per ingredient rather than per id, the same Ingredient may be listed in several categories
+        servings = Counter(ingredients[ingredient_id] for ingredient_id in path_ids)
+        for ingredient_id in path_ids:
+            ingredient = ingredients[ingredient_id]
+            if ingredient.stock < servings[ingredient] * ingredient.quantity:
+                return ingredient_id
+        return -1
+
+    def below_threshold(self, ingredient_ids: List[int]) -> List[int]:
+        ingredients = self.ingredients
+        return [i for i in dict.fromkeys(ingredient_ids) if ingredients[i].is_below_threshold()]
+
+    def nearest_neighbour_route(self, start_id: int, ingredient_ids: List[int]) -> List[int]:
+        distances = self.distances
+        remaining = list(ingredient_ids)
+        route = []
+        current_id = start_id
+        while remaining:
+            row = distances[current_id]
+            current_id = remaining.pop(min(range(len(remaining)), key=lambda i: row[remaining[i]]))
+            route.append(current_id)
+        return route
+
+    def two_opt(self, start_id: int, route: List[int], end_id: int) -> List[int]:
+        distances = self.distances
+        path = [start_id, *route, end_id]
+        improved = True
+        while improved:
+            improved = False
+            for i in range(1, len(path) - 2):
+                for j in range(i + 1, len(path) - 1):
+                    a, b, c, d = path[i - 1], path[i], path[j], path[j + 1]
+                    # Small tolerance so floating-point ties can't make the swaps cycle
+                    if distances[a][c] + distances[b][d] < distances[a][b] + distances[c][d] - 1e-9:
+                        path[i:j + 1] = path[i:j + 1][::-1]
+                        improved = True
+        return path[1:-1]
+
+    def held_karp(self, start_id: int, ingredient_ids: Sequence[int], end_id: int) -> List[int]:
+        distances = self.distances
+        n = len(ingredient_ids)
+        if n == 0:
+            return []
+        full_mask = (1 << n) - 1
+        # cost[mask][last]: shortest route from start_id through the picks in mask, ending at pick last
+        cost = [[inf] * n for _ in range(1 << n)]
+        parent = [[-1] * n for _ in range(1 << n)]
+        for j, ingredient_id in enumerate(ingredient_ids):
+            cost[1 << j][j] = distances[start_id][ingredient_id]
+        for mask in range(1, full_mask):
+            for last in range(n):
+                route_cost = cost[mask][last]
+                if route_cost == inf:
+                    continue
+                row = distances[ingredient_ids[last]]
+                for j in range(n):
+                    if mask & (1 << j):
+                        continue
+                    next_mask = mask | (1 << j)
+                    next_cost = route_cost + row[ingredient_ids[j]]
+                    if next_cost < cost[next_mask][j]:
+                        cost[next_mask][j] = next_cost
+                        parent[next_mask][j] = last
+
+        last = min(range(n), key=lambda j: cost[full_mask][j] + distances[ingredient_ids[j]][end_id])
+        route = []
+        mask = full_mask
+        while last != -1:
+            route.append(ingredient_ids[last])
+            mask, last = mask ^ (1 << last), parent[mask][last]
+        route.reverse()
+        return route
+
+    def order_toppings(self, start_id: int, topping_ids: List[int], end_id: int) -> List[int]:
+        key = (start_id, tuple(sorted(topping_ids)), end_id)
+        route = self.topping_routes.get(key)
+        if route is None:
+            route = self._plan_toppings(*key)
+            if len(self.topping_routes) >= self.max_topping_routes:
+                # Topping lists can be any length, so evict the oldest plan rather than grow without bound
+                del self.topping_routes[next(iter(self.topping_routes))]
+            self.topping_routes[key] = route
+        return list(route)
+
+    def _plan_toppings(self, start_id: int, topping_ids: Tuple[int, ...], end_id: int) -> Tuple[int, ...]:
+        if len(topping_ids) > 12:
+            return tuple(self.two_opt(start_id, self.nearest_neighbour_route(start_id, list(topping_ids)), end_id))
+        return tuple(self.held_karp(start_id, topping_ids, end_id))
 
     def prepare_bowl(self, base_index: int, protein_index: int, topping_indices: List[int], sauce_index: int) -> str:
         self.reset()
 
-        base_node = self.root.children[0].children[base_index]
-        protein_node = base_node.children[protein_index]
-        topping_indices.sort(reverse=True)
-        topping_nodes = [protein_node.children[i] for i in topping_indices]
-        sauce_node = topping_nodes[0].children[sauce_index]
+        try:
+            base_id = self.category_id(self.base_offset, self.bases, base_index)
+            protein_id = self.category_id(self.protein_offset, self.proteins, protein_index)
+            sauce_id = self.category_id(self.sauce_offset, self.sauces, sauce_index)
+            topping_ids = self.order_toppings(protein_id, [self.category_id(self.topping_offset, self.toppings, i) for i in topping_indices], sauce_id)
+            path_ids = [self.bowl_id, base_id, protein_id] + topping_ids + [sauce_id]
 
-        path = [base_node, protein_node, *topping_nodes, sauce_node]
-        
-        self.move_to(Ingredient("Bowl Dispenser", 0, 0, self.bowl_dispenser_position))
+            failed_id = self.short_ingredient(path_ids)
+            if failed_id != -1:
+                raise InsufficientStockError(f"Insufficient stock for {self.names[failed_id]}")
 
-        for node in path:
-            self.traverse_and_prepare(node)
+            self._run_path(path_ids)
+            for ingredient_id in self.below_threshold(path_ids):
+                self.alert_stock(self.names[ingredient_id])
 
-        self.move_to(Ingredient("Final Position", 0, 0, self.final_position))
-        return "Bowl prepared successfully with the selected ingredients and a distance of " + str(round(self.total_distance, 2)) + " u.m."
+            self.move_to(self.final_id)
+            return "Bowl prepared successfully with the selected ingredients and a distance of " + str(round(self.total_distance, 2)) + " u.m."
+        finally:
+            self.flush_log()
 
     def alert_stock(self, ingredient_name: str) -> None:
-        print(f"Alert: Stock of {ingredient_name} is below the threshold.")
+        if self.verbose:
+            self.log.append(f"Alert: Stock of {ingredient_name} is below the threshold.")
+
+    def flush_log(self) -> None:
+        if self.log:
+            sys.stdout.write("\n".join(self.log) + "\n")
+            self.log.clear()
         
     def reset(self):
-        self.current_position = self.initial_position
-        self.current_node = self.root
+        self.current_id = self.initial_id
         self.total_distance = 0.0
 
+def _run_one(order: Order, config: Menu) -> str:
+    base_index, protein_index, topping_indices, sauce_index = order
+    # Work on a private copy so the order never consumes stock from the caller's menu or from other orders
+    cooLex = CooLex(*deepcopy(config), verbose=False)
+    try:
+        return cooLex.prepare_bowl(base_index, protein_index, list(topping_indices), sauce_index)
+    except InsufficientStockError as e:
+        return f"Error: {e}"
+
+def simulate_orders(orders: List[Order], config: Menu) -> List[str]:
+    workers = os.cpu_count() or 1
+    # Orders are tiny, so hand them out in large chunks instead of one process round-trip per order
+    chunksize = max(1, len(orders) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(_run_one, orders, repeat(config), chunksize=chunksize))
+
 def print_options(options: List[Ingredient]) -> None:
     for i, option in enumerate(options):
         print(f"{i + 1}. {option.name}")
 
-def choose_option(options: List[Ingredient], message: str) -> int:
+def show_menu(options: List[Ingredient], message: str) -> Dict[str, int]:
     print("\n")
     print(message)
     print_options(options)
+    return {str(i + 1): i for i in range(len(options))}
+
+def choose_option(options: List[Ingredient], message: str) -> int:
+    valid_choices = show_menu(options, message)
     while True:
-        try:
-            choice = int(input("Enter your choice: "))
-            if 1 <= choice <= len(options):
-                return choice - 1
-            else:
-                print("Invalid choice. Please enter a valid option number.")
-        except ValueError:
-            print("Invalid input. Please enter a number.")
+        choice = valid_choices.get(input("Enter your choice: ").strip())
+        if choice is not None:
+            return choice
+        print("Invalid choice. Please enter a valid option number.")
+
+def choose_options_bulk(options: List[Ingredient], count: int, message: str) -> List[int]:
+    valid_choices = show_menu(options, message)
+    while True:
+        choices = [valid_choices.get(choice.strip()) for choice in input(f"Enter {count} choices separated by commas: ").split(",")]
+        if len(choices) == count and None not in choices:
+            return choices
+        print(f"Invalid choice. Please enter {count} valid option numbers separated by commas.")
 
 def main():
     bowls = Ingredient("bowls", 80, 1, (650, 660))
@@ -184,7 +326,10 @@ def main():
     while cont == 'YES':
         base_index = choose_option(bases, "Choose a base:")
         protein_index = choose_option(proteins, "Choose a protein:")
-        topping_indices = [choose_option(toppings, f"Choose topping {i + 1}:") for i in range(3)]
+        if sys.stdin.isatty():
+            topping_indices = [choose_option(toppings, f"Choose topping {i + 1}:") for i in range(3)]
+        else:
+            topping_indices = choose_options_bulk(toppings, 3, "Choose 3 toppings:")
         sauce_index = choose_option(sauces, "Choose a sauce:")
 
         print("\n")